@@ -0,0 +1,35 @@
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+from Models.domain import DomainOut
+from Models.mail import EmailOut
+from Models.mysql import MySQLDBBase
+from Models.psql import PGDBBase
+from Models.user import User
+
+
+class DomainOverview(BaseModel):
+    domain: DomainOut
+    emails: List[EmailOut]
+    user: Optional[User] = None
+    matching_db_user_mysql_dbs: List[MySQLDBBase] = Field(
+        description="Datenbanken des gleichnamigen Datenbank-Benutzers (xyz00-name → xyz00_name). "
+                    "Unix- und Datenbank-Benutzer sind unabhängig, das ist keine echte Zuordnung"
+    )
+    matching_db_user_pg_dbs: List[PGDBBase] = Field(
+        description="Datenbanken des gleichnamigen Datenbank-Benutzers (xyz00-name → xyz00_name). "
+                    "Unix- und Datenbank-Benutzer sind unabhängig, das ist keine echte Zuordnung"
+    )
+
+
+class UserOverview(BaseModel):
+    user: User
+    domains: List[DomainOut]
+    matching_db_user_mysql_dbs: List[MySQLDBBase] = Field(
+        description="Datenbanken des gleichnamigen Datenbank-Benutzers (xyz00-name → xyz00_name). "
+                    "Unix- und Datenbank-Benutzer sind unabhängig, das ist keine echte Zuordnung"
+    )
+    matching_db_user_pg_dbs: List[PGDBBase] = Field(
+        description="Datenbanken des gleichnamigen Datenbank-Benutzers (xyz00-name → xyz00_name). "
+                    "Unix- und Datenbank-Benutzer sind unabhängig, das ist keine echte Zuordnung"
+    )
@@ -0,0 +1,29 @@
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+from Models.domain import DomainCreate, DomainUpdate
+from Models.mail import EmailIn
+from Models.mysql import MySQLUserBase, MySQLDBBase
+from Models.psql import PGUserBase, PGDBBase
+from Models.user import CreateUser
+
+
+class DomainState(DomainCreate, DomainUpdate):
+    pass
+
+
+class DesiredState(BaseModel):
+    """
+    Gewünschter Zustand einer PAC. Nicht angegebene Listen (null) werden nicht angefasst.
+    """
+    prune: bool = Field(
+        False,
+        description="Löscht Objekte, die in einer angegebenen Liste fehlen. Ohne prune wird nur angelegt und geändert."
+    )
+    users: Optional[List[CreateUser]] = None
+    domains: Optional[List[DomainState]] = None
+    emails: Optional[List[EmailIn]] = None
+    mysql_users: Optional[List[MySQLUserBase]] = None
+    mysql_dbs: Optional[List[MySQLDBBase]] = None
+    pg_users: Optional[List[PGUserBase]] = None
+    pg_dbs: Optional[List[PGDBBase]] = None
@@ -50,6 +50,9 @@ def validate_credentials(file_path: str) -> bool:
             raise ValueError(
                 f"Ungültiger 'key' im API-Eintrag: {api_entry['key']} (Schlüssel sollte ein nicht-leerer String sein).")
 
+        if "admin" in api_entry and not isinstance(api_entry["admin"], bool):
+            raise ValueError(f"'admin' im API-Eintrag sollte true oder false sein: {api_entry}.")
+
         # Validierung des `pacs`-Feldes im Eintrag
         pacs = api_entry["pacs"]
         if isinstance(pacs, list):
@@ -100,6 +103,37 @@ def validate_credentials(file_path: str) -> bool:
     if not isinstance(server["worker"], int) or server["worker"] <= 0:
         raise ValueError(f"'worker' in 'server' sollte eine positive Ganzzahl sein (aktuell: {server['worker']}).")
 
+    # Validierung des optionalen Abschnitts `profiling`
+    profiling = data.get("profiling")
+    if profiling is not None:
+        if not isinstance(profiling, dict):
+            raise ValueError("'profiling' sollte ein Wörterbuch sein.")
+        rate = profiling.get("sample-rate", 0)
+        if not isinstance(rate, (int, float)) or not (0 <= rate <= 1):
+            raise ValueError(f"'sample-rate' in 'profiling' sollte zwischen 0 und 1 liegen (aktuell: {rate}).")
+        for key in ["slow-threshold-ms", "buffer-size"]:
+            if key in profiling and (not isinstance(profiling[key], int) or profiling[key] <= 0):
+                raise ValueError(f"'{key}' in 'profiling' sollte eine positive Ganzzahl sein (aktuell: {profiling[key]}).")
+
+    # Validierung des optionalen Abschnitts `responses`
+    responses = data.get("responses")
+    if responses is not None:
+        if not isinstance(responses, dict):
+            raise ValueError("'responses' sollte ein Wörterbuch sein.")
+        for key in ["compress-min-size", "compressed-cache-bytes"]:
+            if key in responses and (not isinstance(responses[key], int) or responses[key] < 0):
+                raise ValueError(f"'{key}' in 'responses' sollte eine nicht-negative Ganzzahl sein (aktuell: {responses[key]}).")
+
+    # Validierung des optionalen Abschnitts `snapshots`
+    snapshots = data.get("snapshots")
+    if snapshots is not None:
+        if not isinstance(snapshots, dict):
+            raise ValueError("'snapshots' sollte ein Wörterbuch sein.")
+        if "path" in snapshots and (not isinstance(snapshots["path"], str) or not snapshots["path"].strip()):
+            raise ValueError("'path' in 'snapshots' sollte ein nicht-leerer String sein.")
+        for key in ["max-age", "stale-while-revalidate", "stale-if-error"]:
+            if key in snapshots and (not isinstance(snapshots[key], (int, float)) or snapshots[key] < 0):
+                raise ValueError(f"'{key}' in 'snapshots' sollte eine nicht-negative Zahl sein (aktuell: {snapshots[key]}).")
 
     print("Die YAML-Datei ist gültig!")
     return True
@@ -1,5 +1,7 @@
-from collections.abc import Generator
+from collections.abc import Callable, Generator
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
+import contextvars
 import datetime
 import re
 import threading
@@ -7,13 +9,21 @@ import xmlrpc.client
 from xmlrpc.client import Fault
 
 import requests
-import yaml
 from cachetools import cached, Cache
 from fastapi import HTTPException, Request
 
+import profiling
+import snapshots
+from settings import get_api_entries, is_admin_key, read_env
+
 CAS_URL = "https://login.hostsharing.net/cas/v1/tickets"
 SERVICE = "https://config.hostsharing.net:443/hsar/backend"
 BACKEND = "https://config.hostsharing.net:443/hsar/xmlrpc/hsadmin"
+# CAS or the XML-RPC backend being unreachable or broken (requests' connection errors and timeouts are OSErrors).
+# Not Faults or a missing TGT: those are refusals (bad input, permissions, wrong credentials), not outages.
+OUTAGE_ERRORS = (OSError, xmlrpc.client.ProtocolError)
+# calls one hs_parallel batch runs at the same time, each one holds its own grant
+MAX_PARALLEL = 4
 
 class GrantPools:
     """
@@ -33,7 +43,8 @@ class GrantPools:
         key = (username, password)
         (grant, validity) = self._try_get_grant(key)
         if grant is None:
-            grant = get_ticket_grant(username, password)
+            with profiling.phase("cas_grant"):
+                grant = get_ticket_grant(username, password)
             validity = datetime.datetime.now() + datetime.timedelta(seconds=3000)
         try:
             yield grant
@@ -62,16 +73,20 @@ grantPools = GrantPools()
 
 @cached(Cache(maxsize=float("inf")))
 def get_credentials(api_key : str) -> dict[str,str]:
-    with open("env.yaml", "r") as file:
-        data = yaml.safe_load(file)
-        api_entries = list(api for api in data['api'] if api['key'] == api_key)
-        if len(api_entries) != 1:
-            raise HTTPException(500, "API Key not found")
-        allowed_pacs = api_entries[0]["pacs"]
-        if isinstance(allowed_pacs, str):
-            allowed_pacs = allowed_pacs.split(',')
-        filtered_creds = {pac: data["pacs"][pac] for pac in allowed_pacs if pac in data["pacs"]}
-        return filtered_creds
+    data = read_env()
+    api_entries = get_api_entries(api_key, data)
+    if len(api_entries) != 1:
+        raise HTTPException(500, "API Key not found")
+    allowed_pacs = api_entries[0]["pacs"]
+    if isinstance(allowed_pacs, str):
+        allowed_pacs = allowed_pacs.split(',')
+    filtered_creds = {pac: data["pacs"][pac] for pac in allowed_pacs if pac in data["pacs"]}
+    return filtered_creds
+
+
+def require_admin(request: Request) -> None:
+    if not is_admin_key(request.headers.get("Authorization")):
+        raise HTTPException(403, "This API key is not allowed to use admin endpoints")
 
 
 def get_ticket_grant(username: str, password: str) -> str:
@@ -97,12 +112,14 @@ def get_service_ticket(grant: str) -> str:
     )
     return resp.text.strip()
 
-# ---------- Step 3: XML-RPC Call ----------
-def hs_call(request: Request, method: str, param1, param2=None) -> list:
-
+def get_pac(request: Request) -> tuple[str, str]:
+    """
+    The PAC (username) and its password this request works on.
+    """
     headers = request.headers
     api_key = headers.get("Authorization")
-    credentials = get_credentials(api_key)
+    with profiling.phase("credentials"):
+        credentials = get_credentials(api_key)
     if len(credentials) == 1:
         # pac not given, but only one pac configured
         username = list(credentials.keys())[0]
@@ -111,21 +128,57 @@ def hs_call(request: Request, method: str, param1, param2=None) -> list:
     else:
         pac = headers.get("PAC")
         raise HTTPException(400, f"PAC {pac} is not configured in this API, please check your credentials.yaml file")
-    with grantPools.acquire(username, credentials[username]) as grant:
-        service_ticket = get_service_ticket(grant)
-        server = xmlrpc.client.ServerProxy(BACKEND)
-        remote = getattr(server, method)
+    return username, credentials[username]
 
-        if param2:
-            return remote(username, service_ticket, param1, param2)
-        else:
-            return remote(username, service_ticket, param1)
+# ---------- Step 3: XML-RPC Call ----------
+def hs_call(request: Request, method: str, param1, param2=None) -> list:
+    with profiling.trace():
+        return _hs_call(request, method, param1, param2)
 
+def _hs_call(request: Request, method: str, param1, param2=None) -> list:
+    username, password = get_pac(request)
+    try:
+        with grantPools.acquire(username, password) as grant:
+            with profiling.phase("cas_ticket"):
+                service_ticket = get_service_ticket(grant)
+            server = xmlrpc.client.ServerProxy(BACKEND)
+            remote = getattr(server, method)
+
+            with profiling.phase("xmlrpc"):
+                if param2:
+                    return remote(username, service_ticket, param1, param2)
+                else:
+                    return remote(username, service_ticket, param1)
+    finally:
+        if snapshots.enabled() and not method.endswith(".search"):
+            # even a failed write may have changed something
+            module = method.rsplit(".", 1)[0]
+            snapshots.invalidate(username, module + ".search")
+
+
+
+def hs_search(request: Request, module: str, where : dict, live: bool = False) -> list:
+    """
+    live=True bypasses the snapshot store, needed whenever the result is the base of a write.
+    """
+    method = module + ".search"
+    if live or not snapshots.enabled():
+        return hs_call(request, method, where)
+    username, _ = get_pac(request)
+    return snapshots.search(request, username, method, where, lambda: hs_call(request, method, where), OUTAGE_ERRORS)
 
+def hs_parallel(*calls: Callable[[], list]) -> list[Future]:
+    """
+    Runs the calls concurrently, at most MAX_PARALLEL at once. Each one acquires its own grant from the pool, so they
+    don't invalidate each others tickets. The context of the request (e.g. profiling) is passed along.
 
-def hs_search(request: Request, module: str, where : dict) -> list:
-    method = module + ".search"
-    return hs_call(request, method, where)
+    Every batch gets its own threads, so a large batch of one request never delays the calls of another one.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, min(MAX_PARALLEL, len(calls))), thread_name_prefix="hs_call")
+    futures = [executor.submit(contextvars.copy_context().run, call) for call in calls]
+    # the threads end as soon as all calls are done
+    executor.shutdown(wait=False)
+    return futures
 
 def hs_update(request: Request, module: str, where : dict, set: dict):
     method = module + ".update"
@@ -5,12 +5,20 @@ from starlette.responses import Response
 
 from Models.domain import DomainCreate, DomainUpdate, DomainOut
 from Models.mail import EmailIn, EmailOut, EmailUpdate
+from Models.overview import DomainOverview, UserOverview
 from Models.mysql import MySQLDBBase, MySQLUserBase, MySQLUserUpdate, MySQLDBUpdate
 from Models.psql import PGDBUpdate, PGDBBase, PGUserBase, PGUserUpdate
+from Models.state import DesiredState
 from Models.user import CreateUser, User
-from hs_client import hs_search, hs_add, hs_update, hs_delete, hs_api
+from negotiation import negotiate, negotiated_responses
+from hs_client import hs_search, hs_add, hs_update, hs_delete, hs_api, hs_parallel, require_admin
+from profiling import ProfilingMiddleware, slow_requests
+from reconcile import reconcile
+from snapshots import SnapshotHeaderMiddleware
 
 app = FastAPI(title="Hostsharing HS-Admin API", version="1.0.0")
+app.add_middleware(SnapshotHeaderMiddleware)
+app.add_middleware(ProfilingMiddleware)
 
 # -----------------------------
 # Endpoints
@@ -20,11 +28,29 @@ not_found_response = {
     404: {"description": "Item not found"},
 }
 
+def matching_db_user(user: str) -> str:
+    """The database user named like the unix user (xyz00-name → xyz00_name). Only a naming convention, the backend
+    doesn't link unix and database users."""
+    return user.replace("-", "_", 1)
+
+def search_databases(request: Request, user: str) -> list:
+    owner = matching_db_user(user)
+    return hs_parallel(
+        lambda: hs_search(request, "mysqldb", {"owner": owner}),
+        lambda: hs_search(request, "pgdb", {"owner": owner}),
+    )
+
 @app.get("/hsapi")
 def properties_search(request: Request):
     """Fetch Hostsharing API information."""
     return hs_api(request)
 
+@app.get("/admin/profiles", tags=['Admin'])
+def get_profiles(request: Request):
+    """Profiled requests which were slower than the configured threshold or requested via X-Debug-Profile, newest first. Needs an admin API key."""
+    require_admin(request)
+    return slow_requests()
+
 @app.get("/domain/{name}", tags=['Domain'], responses=not_found_response)
 def get_domain(request: Request, name: str) -> DomainOut:
     result = hs_search(request, "domain",  {'name': name})
@@ -33,6 +59,30 @@ def get_domain(request: Request, name: str) -> DomainOut:
     return result[0]
 
 
+@app.get("/domain/{name}/overview", tags=['Domain'], response_model=DomainOverview, responses=not_found_response)
+def get_domain_overview(request: Request, name: str):
+    """Domain mit ihren E-Mail-Adressen, dem Domain-Admin und den Datenbanken des gleichnamigen Datenbank-Benutzers.
+    Die Suchen laufen parallel, sobald die Domain (und damit ihr Benutzer) bekannt ist."""
+    domain_search, email_search = hs_parallel(
+        lambda: hs_search(request, "domain", {"name": name}),
+        lambda: hs_search(request, "emailaddress", {"domain": name}),
+    )
+    result = domain_search.result()
+    if not result:
+        raise HTTPException(status_code=404, detail="Domain not found")
+    domain = result[0]
+    user_search = hs_parallel(lambda: hs_search(request, "user", {"name": domain["user"]}))[0]
+    mysql_search, pg_search = search_databases(request, domain["user"])
+    users = user_search.result()
+    return {
+        "domain": domain,
+        "emails": email_search.result(),
+        "user": users[0] if users else None,
+        "matching_db_user_mysql_dbs": mysql_search.result(),
+        "matching_db_user_pg_dbs": pg_search.result(),
+    }
+
+
 @app.post("/domain", tags=['Domain'], response_model=DomainOut)
 def create_domain(request: Request, dom: DomainCreate):
     params = {"name": dom.name, "user": dom.user}
@@ -48,9 +98,9 @@ def update_domain(request: Request, name: str, dom: DomainUpdate):
 def delete_domain(request: Request, name: str):
     return hs_delete(request, "domain", {"name": name})
 
-@app.get("/domains", tags=['Domain'], response_model=List[DomainOut])
+@app.get("/domains", tags=['Domain'], response_model=List[DomainOut], responses=negotiated_responses)
 def get_all_domains(request: Request):
-    return hs_search(request,"domain", {})
+    return negotiate(request, hs_search(request,"domain", {}), List[DomainOut])
 
 @app.get("/user/{name}", response_model=User, tags=['User'], responses=not_found_response)
 def get_user(request: Request, name: str) :
@@ -60,13 +110,32 @@ def get_user(request: Request, name: str) :
     return result[0]
 
 
+@app.get("/user/{name}/overview", response_model=UserOverview, tags=['User'], responses=not_found_response)
+def get_user_overview(request: Request, name: str):
+    """Benutzer mit seinen Domains und den Datenbanken des gleichnamigen Datenbank-Benutzers, alle Suchen laufen parallel."""
+    user_search, domain_search = hs_parallel(
+        lambda: hs_search(request, "user", {"name": name}),
+        lambda: hs_search(request, "domain", {"user": name}),
+    )
+    mysql_search, pg_search = search_databases(request, name)
+    users = user_search.result()
+    if not users:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {
+        "user": users[0],
+        "domains": domain_search.result(),
+        "matching_db_user_mysql_dbs": mysql_search.result(),
+        "matching_db_user_pg_dbs": pg_search.result(),
+    }
+
+
 @app.post("/user", tags=['User'])
 def add_user(request: Request, user: CreateUser):
     return hs_add(request, "user", user.model_dump(exclude_none=True))
 
-@app.get("/users", response_model=List[User], tags=['User'])
+@app.get("/users", response_model=List[User], tags=['User'], responses=negotiated_responses)
 def all_users(request: Request):
-    return hs_search(request, "user", {})
+    return negotiate(request, hs_search(request, "user", {}), List[User])
 
 
 @app.put("/user/{name}", tags=['User'])
@@ -90,8 +159,8 @@ def get_email(request: Request, domain: str, localpart : str = "") -> EmailOut:
         raise HTTPException(status_code=404, detail="E-Mail-Adresse nicht gefunden")
     return result[0]
 
-@app.get("/email/search", tags=['Email'])
-def search_email(request: Request, domain: str = None, localpart : str = None, target : List[str] = None) -> List[EmailOut]:
+@app.get("/email/search", tags=['Email'], response_model=List[EmailOut], responses=negotiated_responses)
+def search_email(request: Request, domain: str = None, localpart : str = None, target : List[str] = None):
     """Suche E-Mail-Adressen nach localpart oder Domain.
     Angegebene, aber leere Localparts suchen nach der Catch-all Adresse
 
@@ -105,7 +174,7 @@ def search_email(request: Request, domain: str = None, localpart : str = None, t
         # hs api expects comma separated string, not array, so we fix that
         query["target"] = ",".join(target)
 
-    return hs_search(request, "emailaddress", query)
+    return negotiate(request, hs_search(request, "emailaddress", query), List[EmailOut])
 
 @app.post("/email", tags=['Email'])
 def create_email(request: Request, mail: EmailIn):
@@ -122,7 +191,7 @@ def update_email(request: Request, domain: str, update : EmailUpdate, localpart:
 @app.post("/email/{localpart}@{domain}/target", tags=['Email'])
 def add_email_target(request: Request, domain: str, update : EmailUpdate, localpart: str = "") -> List[EmailOut]:
     """Adds a (list of) email targets to the list"""
-    search_result = hs_search(request, "emailaddress", {"localpart": localpart, "domain": domain})
+    search_result = hs_search(request, "emailaddress", {"localpart": localpart, "domain": domain}, live=True)
     mail = search_result[0]
     new_target = mail["target"] + update.target
     return hs_update(request, "emailaddress", where={"localpart": localpart, "domain": domain}, set={"target": new_target})
@@ -134,7 +203,7 @@ def remove_email_target(request: Request, response: Response, domain: str, updat
     if there is a target left the Email-Address is returned
     if there is no target left the Email-Address is deleted and status 204 is returned
     """
-    search_result = hs_search(request, "emailaddress", {"localpart": localpart, "domain": domain})
+    search_result = hs_search(request, "emailaddress", {"localpart": localpart, "domain": domain}, live=True)
     mail = search_result[0]
     new_target = list(set(mail["target"]) - set(update.target))
     if not new_target:
@@ -248,3 +317,16 @@ def update_pg_db(request: Request, name: str, db: PGDBUpdate):
 @app.delete("/pg/db/{name}", tags=['Pgsql'])
 def delete_pg_db(request: Request, name: str):
     return hs_delete(request, "pgdb", {"name": name})
+
+
+@app.put("/state", tags=['State'], responses={
+    422: {"description": "prune would delete objects the desired state still references"},
+    502: {"description": "Some operations failed or were skipped, see plan"},
+})
+def put_state(request: Request, response: Response, state: DesiredState, dry_run: bool = False):
+    """Gleicht die PAC mit dem gewünschten Zustand ab: eine Suche pro Modul, dann nur die nötigen Anlagen, Änderungen und (mit prune) Löschungen.
+    Reihenfolge: Benutzer → Domains → E-Mail-Adressen, Benutzer → Datenbanken. Mit dry_run wird nur der Plan zurückgegeben."""
+    result = reconcile(request, state, dry_run)
+    if not result["ok"]:
+        response.status_code = 502
+    return result
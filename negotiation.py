@@ -0,0 +1,200 @@
+import gzip
+import hashlib
+import json
+import threading
+
+import brotli
+import cbor2
+import msgpack
+from cachetools import cached, Cache, LRUCache
+from fastapi import Request
+from pydantic import TypeAdapter
+from starlette.responses import Response
+
+import profiling
+from settings import get_section
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+COLUMNAR = "application/vnd.hsrest.columnar+json"
+
+MEDIA_TYPES = {
+    JSON: JSON,
+    "application/*": JSON,
+    "*/*": JSON,
+    MSGPACK: MSGPACK,
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.msgpack": MSGPACK,
+    CBOR: CBOR,
+    COLUMNAR: COLUMNAR,
+}
+
+# preferred first, if the client accepts several with the same q
+ENCODINGS = ["br", "gzip"]
+
+negotiated_responses = {
+    200: {"content": {MSGPACK: {}, CBOR: {}, COLUMNAR: {}}},
+    304: {"description": "Not modified (If-None-Match)"},
+}
+
+
+@cached(Cache(maxsize=1))
+def get_config() -> dict:
+    """
+    The optional `responses` section of env.yaml.
+    """
+    config = get_section("responses")
+    return {
+        "compress-min-size": int(config.get("compress-min-size", 1024)),
+        "compressed-cache-bytes": int(config.get("compressed-cache-bytes", 32 * 1024 * 1024)),
+    }
+
+
+class CompressedBodies:
+    """
+    Keeps compressed bodies by digest of the uncompressed body, so repeated polls of unchanged data are only
+    serialized and hashed, but not compressed again. Bounded by the total size of the compressed bodies.
+    """
+    def __init__(self) -> None:
+        self.cache = None
+        self.lock = threading.Lock()
+
+    def get(self, digest: str, encoding: str, body: bytes) -> bytes:
+        key = (digest, encoding)
+        with self.lock:
+            if self.cache is None:
+                self.cache = LRUCache(maxsize=get_config()["compressed-cache-bytes"], getsizeof=len)
+            compressed = self.cache.get(key)
+        if compressed is None:
+            compressed = compress(body, encoding)
+            with self.lock:
+                try:
+                    self.cache[key] = compressed
+                except ValueError:
+                    # larger than the whole cache
+                    pass
+        return compressed
+
+
+compressedBodies = CompressedBodies()
+
+
+def _parse_quality(header: str | None) -> tuple[list[str], set[str]]:
+    """
+    Returns the values of an Accept or Accept-Encoding header ordered by their q-value, and the refused ones (q=0).
+    """
+    if not header:
+        return [], set()
+    values = []
+    refused = set()
+    for position, part in enumerate(header.split(",")):
+        value, _, params = part.partition(";")
+        value = value.strip().lower()
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, number = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        if not value:
+            continue
+        if quality > 0:
+            values.append((-quality, position, value))
+        else:
+            refused.add(value)
+    return [value for _, _, value in sorted(values)], refused
+
+
+def choose_media_type(accept: str | None) -> str:
+    for media_type in _parse_quality(accept)[0]:
+        if media_type in MEDIA_TYPES:
+            return MEDIA_TYPES[media_type]
+    # be lenient, unknown or missing Accept headers get JSON as before
+    return JSON
+
+
+def choose_encoding(accept_encoding: str | None) -> str | None:
+    accepted, refused = _parse_quality(accept_encoding)
+    for encoding in accepted:
+        if encoding in ENCODINGS:
+            return encoding
+        if encoding == "*":
+            # any encoding, except those refused explicitly
+            return next((candidate for candidate in ENCODINGS if candidate not in refused), None)
+    return None
+
+
+def to_columns(rows: list[dict]) -> dict:
+    """
+    Columnar layout of a list of objects: the keys once, then one array of values per object.
+    """
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    return {"columns": columns, "rows": [[row.get(column) for column in columns] for row in rows]}
+
+
+def encode(adapter: TypeAdapter, content, media_type: str) -> bytes:
+    if media_type == JSON:
+        return adapter.dump_json(content, by_alias=True)
+    data = adapter.dump_python(content, mode="json", by_alias=True)
+    if media_type == MSGPACK:
+        return msgpack.packb(data)
+    if media_type == CBOR:
+        return cbor2.dumps(data)
+    if isinstance(data, list):
+        data = to_columns(data)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def negotiate(request: Request, content, model) -> Response:
+    """
+    Validates content against the response model like FastAPI would and renders it in the format the client asked
+    for (JSON, MessagePack, CBOR or columnar JSON). Bodies above the configured size are compressed with brotli or
+    gzip. GET responses carry an ETag and answer a matching If-None-Match (or `*`) with 304.
+    """
+    with profiling.phase("serialize"):
+        adapter = _adapter(model)
+        media_type = choose_media_type(request.headers.get("Accept"))
+        body = encode(adapter, adapter.validate_python(content), media_type)
+
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    encoding = None
+    if len(body) >= get_config()["compress-min-size"]:
+        encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+
+    if request.method != "GET":
+        if encoding:
+            with profiling.phase("compress"):
+                body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+        return Response(body, media_type=media_type, headers=headers)
+
+    digest = hashlib.sha256(media_type.encode() + body).hexdigest()[:32]
+    headers["ETag"] = f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+    if_none_match = _parse_etags(request.headers.get("If-None-Match"))
+    if "*" in if_none_match or headers["ETag"] in if_none_match:
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        with profiling.phase("compress"):
+            body = compressedBodies.get(digest, encoding, body)
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type=media_type, headers=headers)
+
+
+def _parse_etags(header: str | None) -> list[str]:
+    if not header:
+        return []
+    return [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+
+@cached(Cache(maxsize=float("inf")))
+def _adapter(model) -> TypeAdapter:
+    return TypeAdapter(model)
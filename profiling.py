@@ -0,0 +1,268 @@
+import cProfile
+import collections
+import contextvars
+import datetime
+import io
+import itertools
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from cachetools import cached, Cache
+
+from settings import get_section, is_admin_key
+
+DEBUG_HEADER = b"x-debug-profile"
+
+_current = contextvars.ContextVar("request_profile", default=None)
+_null = nullcontext()
+_ids = itertools.count(1)
+
+# From Python 3.12 on cProfile is built on sys.monitoring: only one profiler can be active in the interpreter, and it
+# records every thread. Before, each profiler only saw the thread which enabled it.
+PROCESS_WIDE = sys.version_info >= (3, 12)
+_owner: "RequestProfile | None" = None
+_owner_depth = 0
+_owner_profiler: cProfile.Profile | None = None
+_owner_lock = threading.Lock()
+
+
+class RequestProfile:
+    """
+    Collects per-phase timings and cProfile data of a single request. The call-stack profile only covers the code
+    inside hs_call, everything else (request parsing, Pydantic serialization) shows up as the gap to `total`.
+
+    hs_call may run in a different thread than the middleware (sync endpoints run in the threadpool) and, with
+    concurrent fan-out, in several threads at once. Up to Python 3.11 every thread profiles itself and merges its
+    stats in here. From 3.12 on one profiler covers the whole process, so only one request at a time gets a
+    call-stack profile (`profile_scope: process`), and it also contains whatever else the process did meanwhile.
+    Requests which found the profiler busy only have their phase timings (`profile_skipped`).
+    """
+    def __init__(self, method: str, path: str, reason: str) -> None:
+        # ids are only unique per worker process, each one has its own buffer
+        self.id = f"{os.getpid()}-{next(_ids)}"
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.started = datetime.datetime.now()
+        self.t0 = time.perf_counter()
+        self.status = None
+        self.duration = 0.0
+        self.phases = list[tuple[str, float, float]]()
+        self.stats = None
+        self.skipped = False
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append((name, start, time.perf_counter()))
+
+    @contextmanager
+    def trace(self):
+        if PROCESS_WIDE:
+            with self._trace_process():
+                yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._add_stats(profiler)
+
+    @contextmanager
+    def _trace_process(self):
+        """
+        The first trace of a request enables the profiler if no other request holds it; concurrent traces of the same
+        request (hs_parallel) are covered by it anyway. It is disabled again when the last of them ends.
+        """
+        global _owner, _owner_depth, _owner_profiler
+        with _owner_lock:
+            if _owner is None:
+                profiler = cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError:
+                    # some other tool is profiling the process
+                    profiler = None
+                if profiler is not None:
+                    _owner, _owner_profiler = self, profiler
+            owned = _owner is self
+            if owned:
+                _owner_depth += 1
+            else:
+                self.skipped = True
+        if not owned:
+            yield
+            return
+        try:
+            yield
+        finally:
+            with _owner_lock:
+                _owner_depth -= 1
+                if _owner_depth == 0:
+                    _owner_profiler.disable()
+                    self._add_stats(_owner_profiler)
+                    _owner, _owner_profiler = None, None
+
+    def _add_stats(self, profiler: cProfile.Profile) -> None:
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
+
+    def phase_totals(self) -> dict[str, float]:
+        """
+        Wall-clock time per phase: how long at least one block of it was running. Concurrent blocks (hs_parallel)
+        count once, so a phase never exceeds the total.
+        """
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        totals = dict[str, float]()
+        running_until = dict[str, float]()
+        for name, start, end in phases:
+            until = running_until.get(name, start)
+            covered = max(0.0, end - max(start, until))
+            totals[name] = totals.get(name, 0.0) + covered
+            running_until[name] = max(until, end)
+        return totals
+
+    def server_timing(self) -> str:
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phase_totals().items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.t0) * 1000:.1f}")
+        return ", ".join(parts)
+
+    def report(self, limit: int = 30) -> str:
+        if self.stats is None:
+            return ""
+        out = io.StringIO()
+        with self.lock:
+            self.stats.stream = out
+            self.stats.sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "pid": os.getpid(),
+            "method": self.method,
+            "path": self.path,
+            "reason": self.reason,
+            "started": self.started.isoformat(),
+            "status": self.status,
+            "duration_ms": round(self.duration * 1000, 1),
+            "phases_ms": {name: round(seconds * 1000, 1) for name, seconds in self.phase_totals().items()},
+            "profile": self.report(),
+            "profile_scope": "process" if PROCESS_WIDE else "thread",
+            "profile_skipped": self.skipped,
+        }
+
+
+_slow_requests: collections.deque[RequestProfile] | None = None
+_slow_lock = threading.Lock()
+
+
+@cached(Cache(maxsize=1))
+def get_config() -> dict:
+    """
+    The optional `profiling` section of env.yaml. Without it the middleware passes every request straight through.
+    """
+    config = get_section("profiling")
+    return {
+        "sample-rate": float(config.get("sample-rate", 0.0)),
+        "slow-threshold-ms": float(config.get("slow-threshold-ms", 1000)),
+        "buffer-size": int(config.get("buffer-size", 50)),
+        "enabled": bool(config),
+    }
+
+
+def phase(name: str):
+    """
+    Times a block as one phase of the currently profiled request. A no-op if the request is not profiled.
+    """
+    profile = _current.get()
+    if profile is None:
+        return _null
+    return profile.phase(name)
+
+
+def trace():
+    """
+    Records a call-stack profile of the block for the currently profiled request. A no-op if the request is not profiled.
+    """
+    profile = _current.get()
+    if profile is None:
+        return _null
+    return profile.trace()
+
+
+def slow_requests() -> list[dict]:
+    with _slow_lock:
+        profiles = list(_slow_requests or [])
+    return [profile.to_dict() for profile in reversed(profiles)]
+
+
+def _keep(profile: RequestProfile, config: dict) -> None:
+    global _slow_requests
+    with _slow_lock:
+        if _slow_requests is None:
+            _slow_requests = collections.deque(maxlen=config["buffer-size"])
+        _slow_requests.append(profile)
+
+
+class ProfilingMiddleware:
+    """
+    Pure ASGI middleware which profiles a sampled fraction of the requests, and every request of an admin key which
+    sends the `X-Debug-Profile` header. Profiled requests slower than the threshold (and all explicitly requested
+    ones) are kept in a bounded ring buffer, see GET /admin/profiles.
+    """
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        config = get_config()
+        if not config["enabled"]:
+            return await self.app(scope, receive, send)
+
+        reason = None
+        headers = dict(scope["headers"])
+        if DEBUG_HEADER in headers and is_admin_key(headers.get(b"authorization", b"").decode("latin-1")):
+            reason = "requested"
+        elif config["sample-rate"] > 0 and random.random() < config["sample-rate"]:
+            reason = "sampled"
+        if reason is None:
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(scope["method"], scope["path"], reason)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                if reason == "requested":
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", profile.server_timing().encode("latin-1")),
+                        (b"x-profile-id", profile.id.encode("latin-1")),
+                    ]
+            await send(message)
+
+        token = _current.set(profile)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            profile.duration = time.perf_counter() - profile.t0
+            if reason == "requested" or profile.duration * 1000 >= config["slow-threshold-ms"]:
+                _keep(profile, config)
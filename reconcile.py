@@ -0,0 +1,193 @@
+from concurrent.futures import Future
+
+from fastapi import HTTPException, Request
+
+from Models.state import DesiredState
+from hs_client import hs_call, hs_add, hs_update, hs_delete, hs_parallel, get_pac
+
+
+class Module:
+    """
+    How a list of the desired state maps onto a hs module: which fields identify an object, which can be changed
+    with an update, and in which stage it is added (objects of a later stage may depend on earlier ones).
+    Write-only fields (passwords) can't be compared and are only used when adding. Only fields the client actually
+    sent are compared, model defaults (like the MySQL host '%') are only used when adding.
+    """
+    def __init__(self, name: str, field: str, key: list[str], updatable: list[str], stage: int) -> None:
+        self.name = name
+        self.field = field
+        self.key = key
+        self.updatable = updatable
+        self.stage = stage
+
+    def identity(self, values: dict) -> tuple:
+        return tuple(values.get(field) for field in self.key)
+
+
+MODULES = [
+    Module("user", "users", ["name"],
+           ["comment", "shell", "quota_softlimit", "quota_hardlimit", "storage_softlimit", "storage_hardlimit"], 0),
+    Module("domain", "domains", ["name"],
+           ["validsubdomainnames", "domainoptions", "passengerpython", "passengernodejs", "passengerruby", "fcgiphpbin"], 1),
+    Module("mysqluser", "mysql_users", ["name"], ["host"], 1),
+    Module("pguser", "pg_users", ["name"], [], 1),
+    Module("emailaddress", "emails", ["localpart", "domain"], ["target"], 2),
+    Module("mysqldb", "mysql_dbs", ["name"], ["owner"], 2),
+    Module("pgdb", "pg_dbs", ["name"], ["owner"], 2),
+]
+
+
+def _same(desired, current) -> bool:
+    if isinstance(desired, list) or isinstance(current, list):
+        # the order of targets or domain options makes no difference
+        return sorted(map(str, desired or [])) == sorted(map(str, current or []))
+    return str(desired) == str(current)
+
+
+def _desired_values(module: Module, item, exclude_unset: bool = False) -> dict:
+    values = item.model_dump(exclude_none=True, exclude_unset=exclude_unset)
+    if module.name == "emailaddress":
+        # an empty localpart is the catch-all address
+        values.setdefault("localpart", "")
+    return values
+
+
+def snapshot(request: Request, modules: list[Module]) -> dict[str, list]:
+    """
+    One search per module, all at once. Deliberately not through the snapshot store, the plan needs the live state.
+    """
+    futures = hs_parallel(*(lambda module=module: hs_call(request, module.name + ".search", {}) for module in modules))
+    return {module.name: future.result() for module, future in zip(modules, futures)}
+
+
+# (list of the desired state, field, module the value names an object of)
+REFERENCES = [
+    ("domains", "user", "user"),
+    ("emails", "domain", "domain"),
+    ("emails", "target", "user"),
+    ("mysql_dbs", "owner", "mysqluser"),
+    ("pg_dbs", "owner", "pguser"),
+]
+
+
+def _protected(module: Module, key: tuple, pac: str) -> bool:
+    """
+    The PAC user and the PAC's default domain are never deleted.
+    """
+    return (module.name == "user" and key == (pac,)) or (module.name == "domain" and key == (f"{pac}.hostsharing.net",))
+
+
+def _referenced(state: DesiredState, pruned: dict[str, set]) -> list[str]:
+    """
+    Objects which prune would delete, but the desired state still refers to.
+    """
+    conflicts = []
+    for field, attribute, module in REFERENCES:
+        for item in getattr(state, field) or []:
+            values = getattr(item, attribute)
+            for value in values if isinstance(values, list) else [values]:
+                if (value,) in pruned.get(module, set()):
+                    conflicts.append(f"{field}: {attribute} {value}")
+    return conflicts
+
+
+def plan(state: DesiredState, current: dict[str, list], pac: str) -> list[dict]:
+    operations = []
+    deletes = []
+    pruned = dict[str, set]()
+    for module in MODULES:
+        desired = getattr(state, module.field)
+        if desired is None:
+            continue
+        existing = {module.identity(item): item for item in current[module.name]}
+        wanted = {}
+        for item in desired:
+            values = _desired_values(module, item)
+            wanted[module.identity(values)] = (values, _desired_values(module, item, exclude_unset=True))
+
+        for key, (values, given) in wanted.items():
+            where = dict(zip(module.key, key))
+            if key not in existing:
+                operations.append({"module": module.name, "action": "add", "where": where, "set": values})
+                continue
+            changes = {field: given[field] for field in module.updatable
+                       if field in given and not _same(given[field], existing[key].get(field))}
+            if changes:
+                operations.append({"module": module.name, "action": "update", "where": where, "set": changes})
+
+        if state.prune:
+            for key in sorted(existing.keys() - wanted.keys(), key=str):
+                if _protected(module, key, pac):
+                    continue
+                pruned.setdefault(module.name, set()).add(key)
+                deletes.append({"module": module.name, "action": "delete", "where": dict(zip(module.key, key))})
+
+    conflicts = _referenced(state, pruned)
+    if conflicts:
+        raise HTTPException(422, "prune would delete objects the desired state still references: " + "; ".join(conflicts))
+    return operations + deletes
+
+
+def stages(operations: list[dict]) -> list[list[dict]]:
+    """
+    Deletes first, dependents before their owners (email/databases, then domains/db users, then users), afterwards
+    adds and updates in the opposite order. Operations within one stage don't depend on each other.
+    """
+    stage_of = {module.name: module.stage for module in MODULES}
+    levels = sorted({module.stage for module in MODULES})
+    result = []
+    for level in reversed(levels):
+        result.append([op for op in operations if op["action"] == "delete" and stage_of[op["module"]] == level])
+    for level in levels:
+        result.append([op for op in operations if op["action"] != "delete" and stage_of[op["module"]] == level])
+    return [stage for stage in result if stage]
+
+
+def _execute(request: Request, operation: dict):
+    if operation["action"] == "add":
+        return hs_add(request, operation["module"], operation["set"])
+    if operation["action"] == "update":
+        return hs_update(request, operation["module"], operation["where"], operation["set"])
+    return hs_delete(request, operation["module"], operation["where"])
+
+
+def apply(request: Request, operations: list[dict]) -> None:
+    """
+    Runs the stages one after another and the operations of a stage concurrently. Stops after a stage with errors,
+    the following stages are marked as skipped. Every operation ends up with a status, whatever went wrong, so the
+    client always learns what was already applied.
+    """
+    failed = False
+    for stage in stages(operations):
+        if failed:
+            for operation in stage:
+                operation["status"] = "skipped"
+            continue
+        futures: list[Future] = hs_parallel(*(lambda operation=operation: _execute(request, operation) for operation in stage))
+        for operation, future in zip(stage, futures):
+            try:
+                future.result()
+                operation["status"] = "ok"
+            except Exception as e:
+                operation["status"] = "error"
+                operation["error"] = e.detail if isinstance(e, HTTPException) else f"{type(e).__name__}: {e}"
+                failed = True
+
+
+def _public(operation: dict) -> dict:
+    if "password" not in operation.get("set", {}):
+        return operation
+    return {**operation, "set": {**operation["set"], "password": "***"}}
+
+
+def reconcile(request: Request, state: DesiredState, dry_run: bool) -> dict:
+    pac, _ = get_pac(request)
+    modules = [module for module in MODULES if getattr(state, module.field) is not None]
+    operations = plan(state, snapshot(request, modules), pac)
+    if not dry_run:
+        apply(request, operations)
+    return {
+        "dry_run": dry_run,
+        "ok": all(operation.get("status", "ok") == "ok" for operation in operations),
+        "plan": [_public(operation) for operation in sum(stages(operations), [])],
+    }
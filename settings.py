@@ -0,0 +1,42 @@
+import yaml
+from cachetools import cached, Cache
+
+ENV_FILE = "env.yaml"
+
+
+def read_env() -> dict:
+    """
+    Reads env.yaml from disk. Used for API keys and PACs, so keys added to env.yaml work without a restart.
+    """
+    with open(ENV_FILE, "r") as file:
+        return yaml.safe_load(file)
+
+
+@cached(Cache(maxsize=1))
+def load_env() -> dict:
+    """
+    env.yaml as read once per process, for the optional tuning sections (e.g. `profiling`), which may be missing.
+    Changes to those need a restart.
+    """
+    return read_env()
+
+
+def get_api_entries(api_key: str, data: dict | None = None) -> list[dict]:
+    if data is None:
+        data = read_env()
+    return list(api for api in data['api'] if api['key'] == api_key)
+
+
+def is_admin_key(api_key: str | None) -> bool:
+    """
+    An API key is an admin key if its entry in env.yaml carries `admin: true`. Reads env.yaml on every call, it is only
+    needed for admin endpoints and the X-Debug-Profile header.
+    """
+    if not api_key:
+        return False
+    entries = get_api_entries(api_key)
+    return len(entries) == 1 and entries[0].get("admin", False) is True
+
+
+def get_section(name: str) -> dict:
+    return load_env().get(name) or {}
@@ -0,0 +1,235 @@
+import json
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+
+from cachetools import cached, Cache
+from fastapi import Request
+
+import profiling
+from settings import get_section
+
+@cached(Cache(maxsize=1))
+def get_config() -> dict:
+    """
+    The optional `snapshots` section of env.yaml. Without it every search goes to the backend as before.
+
+    - max-age: snapshots younger than this (seconds) are served without asking the backend
+    - stale-while-revalidate: older snapshots up to this age are served immediately and refreshed in the background
+    - stale-if-error: snapshots up to this age are served if the backend fails
+    """
+    config = get_section("snapshots")
+    return {
+        "enabled": bool(config),
+        "path": config.get("path", "snapshots.sqlite"),
+        "max-age": float(config.get("max-age", 0)),
+        "stale-while-revalidate": float(config.get("stale-while-revalidate", 0)),
+        "stale-if-error": float(config.get("stale-if-error", 86400)),
+    }
+
+
+class SnapshotStore:
+    """
+    Last known result of every `*.search` call per PAC and query, persisted in SQLite so it survives restarts.
+
+    SQLite connections can't be shared between threads, so every thread gets its own. WAL mode lets the uvicorn
+    workers (separate processes) read while another one writes.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.local = threading.local()
+        self.refreshing = set[tuple[str, str, str]]()
+        self.lock = threading.Lock()
+        with self._connection() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS snapshot (
+                    pac TEXT NOT NULL,
+                    method TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    fetched REAL NOT NULL,
+                    invalidated INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (pac, method, query)
+                )
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS invalidation (
+                    pac TEXT NOT NULL,
+                    method TEXT NOT NULL,
+                    invalidated REAL NOT NULL,
+                    PRIMARY KEY (pac, method)
+                )
+            """)
+
+    def _connection(self) -> sqlite3.Connection:
+        if not hasattr(self.local, "connection"):
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return self.local.connection
+
+    def load(self, pac: str, method: str, query: str) -> tuple[list, float, bool] | None:
+        row = self._connection().execute(
+            "SELECT result, fetched, invalidated FROM snapshot WHERE pac = ? AND method = ? AND query = ?",
+            (pac, method, query)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], bool(row[2])
+
+    def save(self, pac: str, method: str, query: str, result: list, started: float) -> None:
+        """
+        Stores a result fetched at `started`. Skipped if a write invalidated the module since then, the result may
+        predate that write. A single statement, so it is atomic against invalidations of the other workers.
+        """
+        with self._connection() as connection:
+            connection.execute(
+                """
+                INSERT OR REPLACE INTO snapshot (pac, method, query, result, fetched, invalidated)
+                SELECT ?, ?, ?, ?, ?, 0
+                WHERE NOT EXISTS (SELECT 1 FROM invalidation WHERE pac = ? AND method = ? AND invalidated >= ?)
+                """,
+                (pac, method, query, json.dumps(result, default=str), started, pac, method, started)
+            )
+
+    def invalidate(self, pac: str, method: str) -> None:
+        """
+        Called after writes. Invalidated snapshots are only served if the backend fails.
+        """
+        with self._connection() as connection:
+            connection.execute("UPDATE snapshot SET invalidated = 1 WHERE pac = ? AND method = ?", (pac, method))
+            connection.execute(
+                "INSERT OR REPLACE INTO invalidation (pac, method, invalidated) VALUES (?, ?, ?)",
+                (pac, method, time.time())
+            )
+
+    def refresh_in_background(self, pac: str, method: str, query: str, fetch: Callable[[], list]) -> None:
+        key = (pac, method, query)
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                started = time.time()
+                self.save(pac, method, query, fetch(), started)
+            except Exception as e:
+                print(f"Background refresh of {method} for {pac} failed: {e}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> SnapshotStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SnapshotStore(get_config()["path"])
+        return _store
+
+
+def enabled() -> bool:
+    return get_config()["enabled"]
+
+
+def _mark(request: Request, age: float, state: str) -> None:
+    """
+    Remembers the oldest snapshot used for this request, SnapshotHeaderMiddleware turns it into response headers.
+    """
+    previous = getattr(request.state, "snapshot_age", None)
+    if previous is None or age > previous:
+        request.state.snapshot_age = age
+        request.state.snapshot_state = state
+
+
+def search(request: Request, pac: str, method: str, where: dict, fetch: Callable[[], list],
+           errors: tuple[type[Exception], ...]) -> list:
+    """
+    Answers a search from the snapshot store or with fetch. If fetch raises one of `errors` (backend outages), a
+    snapshot within stale-if-error is served instead.
+    """
+    config = get_config()
+    store = get_store()
+    query = json.dumps(where, sort_keys=True)
+    with profiling.phase("snapshot"):
+        try:
+            snapshot = store.load(pac, method, query)
+        except sqlite3.Error as e:
+            print(f"Reading the snapshot of {method} for {pac} failed: {e}")
+            snapshot = None
+
+    if snapshot is not None:
+        result, fetched, invalidated = snapshot
+        age = time.time() - fetched
+        if not invalidated and age < config["max-age"]:
+            _mark(request, age, "fresh")
+            return result
+        if not invalidated and age < config["stale-while-revalidate"]:
+            store.refresh_in_background(pac, method, query, fetch)
+            _mark(request, age, "stale")
+            return result
+
+    started = time.time()
+    try:
+        result = fetch()
+    except errors:
+        if snapshot is None:
+            raise
+        result, fetched, _ = snapshot
+        age = time.time() - fetched
+        if age >= config["stale-if-error"]:
+            raise
+        print(f"{method} for {pac} failed, serving a snapshot of age {int(age)}s")
+        _mark(request, age, "stale-if-error")
+        return result
+    with profiling.phase("snapshot"):
+        try:
+            store.save(pac, method, query, result, started)
+        except sqlite3.Error as e:
+            # e.g. the lock timeout with several busy workers, or a full disk: the live result is still good
+            print(f"Saving the snapshot of {method} for {pac} failed: {e}")
+    return result
+
+
+def invalidate(pac: str, method: str) -> None:
+    """
+    Called after writes, which already happened: a failure is logged, not raised.
+    """
+    try:
+        get_store().invalidate(pac, method)
+    except sqlite3.Error as e:
+        print(f"Invalidating the snapshots of {method} for {pac} failed, they may be served stale: {e}")
+
+
+class SnapshotHeaderMiddleware:
+    """
+    Pure ASGI middleware which adds `Age` and `X-Snapshot` (fresh, stale or stale-if-error) to responses which were
+    served (partly) from the snapshot store.
+    """
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not enabled():
+            return await self.app(scope, receive, send)
+
+        async def send_with_age(message):
+            if message["type"] == "http.response.start":
+                state = scope.get("state", {})
+                if state.get("snapshot_age") is not None:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"age", str(int(state["snapshot_age"])).encode("latin-1")),
+                        (b"x-snapshot", state["snapshot_state"].encode("latin-1")),
+                    ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_age)
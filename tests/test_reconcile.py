@@ -0,0 +1,103 @@
+import pytest
+from fastapi import HTTPException
+
+from Models.mysql import MySQLUserBase
+from Models.state import DesiredState, DomainState
+from Models.user import CreateUser
+from reconcile import _same, plan, stages
+
+
+def test_same_ignores_list_order_and_types():
+    assert _same(["b", "a"], ["a", "b"])
+    assert _same(None, [])
+    assert _same("100", 100)
+    assert not _same(["a"], ["a", "b"])
+    assert not _same("x", "y")
+
+
+def test_prune_never_deletes_the_pac_user():
+    state = DesiredState(prune=True, users=[CreateUser(name="xyz00-keep")])
+    current = {"user": [{"name": "xyz00"}, {"name": "xyz00-keep"}, {"name": "xyz00-old"}]}
+
+    operations = plan(state, current, "xyz00")
+
+    assert operations == [{"module": "user", "action": "delete", "where": {"name": "xyz00-old"}}]
+
+
+def test_without_prune_nothing_is_deleted():
+    state = DesiredState(users=[])
+    current = {"user": [{"name": "xyz00"}, {"name": "xyz00-old"}]}
+
+    assert plan(state, current, "xyz00") == []
+
+
+def test_model_defaults_are_not_compared():
+    state = DesiredState(mysql_users=[MySQLUserBase(name="xyz00_db", password="secret")])
+    current = {"mysqluser": [{"name": "xyz00_db", "host": "localhost"}]}
+
+    assert plan(state, current, "xyz00") == []
+
+
+def test_model_defaults_are_used_when_adding():
+    state = DesiredState(mysql_users=[MySQLUserBase(name="xyz00_db", password="secret")])
+
+    operations = plan(state, {"mysqluser": []}, "xyz00")
+
+    assert operations[0]["action"] == "add"
+    assert operations[0]["set"]["host"] == "%"
+
+
+def test_passwords_are_not_compared():
+    state = DesiredState(users=[CreateUser(name="xyz00-a", password="Secret!1", comment="new")])
+    current = {"user": [{"name": "xyz00-a", "comment": "old"}]}
+
+    operations = plan(state, current, "xyz00")
+
+    assert operations == [{"module": "user", "action": "update", "where": {"name": "xyz00-a"}, "set": {"comment": "new"}}]
+
+
+def test_stages_delete_dependents_first_and_add_owners_first():
+    operations = [
+        {"module": "user", "action": "add"},
+        {"module": "emailaddress", "action": "add"},
+        {"module": "domain", "action": "update"},
+        {"module": "mysqldb", "action": "delete"},
+        {"module": "user", "action": "delete"},
+        {"module": "domain", "action": "delete"},
+        {"module": "pgdb", "action": "add"},
+    ]
+
+    order = [[(op["module"], op["action"]) for op in stage] for stage in stages(operations)]
+
+    assert order == [
+        [("mysqldb", "delete")],
+        [("domain", "delete")],
+        [("user", "delete")],
+        [("user", "add")],
+        [("domain", "update")],
+        [("emailaddress", "add"), ("pgdb", "add")],
+    ]
+
+
+def test_prune_never_deletes_the_default_domain():
+    state = DesiredState(prune=True, domains=[])
+    current = {"domain": [{"name": "xyz00.hostsharing.net"}, {"name": "old.org"}]}
+
+    operations = plan(state, current, "xyz00")
+
+    assert operations == [{"module": "domain", "action": "delete", "where": {"name": "old.org"}}]
+
+
+def test_prune_rejects_deleting_referenced_objects():
+    state = DesiredState(
+        prune=True,
+        users=[CreateUser(name="xyz00-new")],
+        domains=[DomainState(name="ex.org", user="xyz00-dom")],
+    )
+    current = {"user": [{"name": "xyz00"}, {"name": "xyz00-dom"}], "domain": [{"name": "ex.org", "user": "xyz00-dom"}]}
+
+    with pytest.raises(HTTPException) as error:
+        plan(state, current, "xyz00")
+
+    assert error.value.status_code == 422
+    assert "xyz00-dom" in error.value.detail